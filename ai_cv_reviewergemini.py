@@ -1,10 +1,19 @@
+import asyncio
+import email.utils
+import hashlib
+import math
 import os
-import json
 import textwrap
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
+from typing import Annotated, Literal
 
-import requests
+import aiohttp
+import msgspec
+import orjson
+
+from cache import ResponseCache, make_key
 
 
 
@@ -16,9 +25,58 @@ if not GEMINI_API_KEY:
     raise RuntimeError("Lūdzu iestatiet GEMINI_API_KEY vides mainīgo ar jūsu API atslēgu.")
 
 
+API_ROOT = "https://generativelanguage.googleapis.com/v1beta"
 API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent"
+BATCH_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:batchGenerateContent"
 MODEL_NAME = "gemini-2.5-flash"
 TEMPERATURE = 0.2 
+REQUESTS_PER_MINUTE = int(os.environ.get("GEMINI_RPM", "60"))  # pielāgojiet savai kvotai
+REQUEST_TIMEOUT = 60
+MAX_INPUT_TOKENS = 1_048_576  # gemini-2.5-flash ievades limits
+CHARS_PER_TOKEN = 4  # aptuvens novērtējums bez API izsaukuma
+# Pārejošas kļūdas atkārtojam
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRY_DELAY = 60
+
+# Flex līmenis: 50% lētāk, atbilde minūšu laikā; tukšs = standarta līmenis
+SERVICE_TIER = os.environ.get("GEMINI_SERVICE_TIER", "flex")
+FLEX_FALLBACK_STATUSES = {429, 503}
+FLEX_REQUEST_TIMEOUT = 15 * 60  # flex atbildes var aizņemt vairākas minūtes
+# Littla likums: vienlaicīgi pieprasījumi ≈ RPM × vidējais atbildes laiks (min), citādi limits ir semafors, nevis RPM
+FLEX_EXPECTED_LATENCY = 3 * 60
+STANDARD_EXPECTED_LATENCY = 10
+_EXPECTED_LATENCY = FLEX_EXPECTED_LATENCY if SERVICE_TIER == "flex" else STANDARD_EXPECTED_LATENCY
+CONCURRENCY = int(os.environ.get("GEMINI_CONCURRENCY", "0")) or max(1, math.ceil(REQUESTS_PER_MINUTE * _EXPECTED_LATENCY / 60))
+# Viena HTTP sesija ar keep-alive savienojumu kopu; katram vienlaicīgam pieprasījumam savs savienojums
+POOL_SIZE = CONCURRENCY
+KEEPALIVE_TIMEOUT = 30
+
+# Batch API: viens darbs visiem CV, 50% lētāk, rezultāts līdz 24h laikā
+USE_BATCH = os.environ.get("GEMINI_USE_BATCH", "") == "1"
+BATCH_DISPLAY_NAME = "cv-review"
+BATCH_POLL_INTERVAL = 30
+BATCH_INLINE_LIMIT = 20 * 1024 * 1024
+# Jau iesniegta darba nosaukums (batches/...), lai turpinātu gaidīt tā rezultātu, nevis iesniegtu jaunu
+BATCH_RESUME_NAME = os.environ.get("GEMINI_BATCH_NAME", "")
+
+# Konteksta kešs: instrukcijas + JD tiek augšupielādētas vienreiz un atkārtoti izmantotas
+USE_PROMPT_CACHE = os.environ.get("GEMINI_PROMPT_CACHE", "1") == "1"
+# TTL tiek aprēķināts no CV skaita un RPM; rezerve sedz atkārtojumus un pēdējo (flex) atbildi
+PROMPT_CACHE_TTL_MARGIN = 5 * 60
+PROMPT_CACHE_MIN_TOKENS = 1024  # gemini-2.5-flash nekešo īsākus prefiksus
+CACHE_MISSING_STATUSES = {400, 403, 404}  # statusi, ar kuriem API atbild uz beigušos/neesošu kešu
+
+# Lokālais atbilžu kešs atkārtotām palaišanām ar tiem pašiem JD + CV
+USE_RESPONSE_CACHE = os.environ.get("GEMINI_RESPONSE_CACHE", "1") == "1"
+
+# Semantiskā deduplikācija: gandrīz identiskiem CV (kosinuss >= slieksnis) izmantojam jau saņemto rezultātu
+USE_CV_DEDUPE = os.environ.get("GEMINI_DEDUPE_CVS", "") == "1"
+DEDUPE_THRESHOLD = 0.9
+EMBED_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-embedding-001:embedContent"
+EMBED_DIMENSIONS = 768
+EMBED_REQUESTS_PER_MINUTE = int(os.environ.get("GEMINI_EMBED_RPM", "100"))  # embedding kvota ir atsevišķa
 
 BASE_DIR = Path.cwd()
 SAMPLE_DIR = BASE_DIR / "sample_inputs"
@@ -27,20 +85,44 @@ PROMPT_DIR = BASE_DIR / "prompts"
 OUTPUT_DIR.mkdir(exist_ok=True)
 PROMPT_DIR.mkdir(exist_ok=True)
 
+PROMPT_PREFIX_PATH = PROMPT_DIR / "_prefix.md"
+RESPONSE_CACHE_PATH = BASE_DIR / ".cv_review_cache.sqlite3"
+
 JD_PATH = SAMPLE_DIR / "jd.txt" 
 CV_PATHS = [SAMPLE_DIR / f"cv{i}.txt" for i in (1, 2, 3)] 
 
 
-REQUIRED_KEYS = ["match_score", "summary", "strengths", "missing_requirements", "verdict"]
+# Modeļa atbildes struktūra; no tās tiek ģenerēta arī Gemini atbildes shēma
+# (bez docstring, lai shēmā modelim nenonāktu apraksts latviski)
+class HRReview(msgspec.Struct):
+    match_score: Annotated[int, msgspec.Meta(ge=0, le=100)]
+    summary: str
+    strengths: list[str]
+    missing_requirements: list[str]
+    verdict: Literal["strong match", "possible match", "not a match"]
 
 
-def read_text(path: Path) -> str:
-    with path.open("r", encoding="utf-8") as f:
-        return f.read().strip()
+# Shēma un ģenerēšanas konfigurācija nemainās starp pieprasījumiem, tāpēc tās veidojam vienreiz
+_RESPONSE_SCHEMA = msgspec.json.schema_components([HRReview])[1]["HRReview"]
 
+# Dekoderis ir specializēts HRReview struktūrai: parsē un validē JSON vienā C līmeņa solī
+_DECODER = msgspec.json.Decoder(HRReview)
 
-def build_prompt(jd_text: str, cv_text: str, candidate_label: str = "Candidate") -> str:
-    instruct = textwrap.dedent("""
+_GENERATION_CONFIG = {
+    "temperature": TEMPERATURE,
+    "responseMimeType": "application/json",
+    "responseJsonSchema": _RESPONSE_SCHEMA
+}
+
+JSON_DUMP_OPTIONS = orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+
+# Failu rakstīšana notiek fonā, lai nākamais API pieprasījums nesāktos pēc diska
+IO_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="cv-io")
+
+
+# Prefikss (instrukcijas + JD) ir vienāds visiem kandidātiem, lai to var kešot;
+# veidnes tiek dedent-otas vienreiz importa laikā
+_PROMPT_PREFIX = textwrap.dedent("""
     You are a hiring-focused assistant. Compare a Job Description (JD) with a candidate CV and
     produce a single JSON object (no extra text, no commentary) that assesses fit.
 
@@ -66,183 +148,654 @@ def build_prompt(jd_text: str, cv_text: str, candidate_label: str = "Candidate")
     4) missing_requirements: up to 6 items from the JD not found in the CV; prefer exact phrasing.
     5) verdict: map from match_score using the ranges above.
 
-    Now compare the Job Description and the CV below.
+    Compare the Job Description below with the candidate CV that follows it and produce the JSON.
 
     JOB DESCRIPTION:
     ------------------------------------------------------------
     {jd}
     ------------------------------------------------------------
 
+    """)
+
+_PROMPT_SUFFIX = textwrap.dedent("""\
     {candidate_label} CV:
     ------------------------------------------------------------
     {cv}
     ------------------------------------------------------------
+    """)
+
 
-    Produce the JSON now.
-    """).format(jd=jd_text, cv=cv_text, candidate_label=candidate_label)
+# Visa atskaite vienā veidnē — viena virknes alokācija katram kandidātam
+_REPORT_TEMPLATE = (
+    "# CV Review — {candidate_label} (Gemini Flash 2.5)\n\n"
+    "**Match score:** {match_score} / 100  \n"
+    "**Verdict:** {verdict}{reused_note}\n\n"
+    "## Summary\n\n"
+    "{summary}\n\n"
+    "## Strengths (from CV) / Galvenās prasmes un pieredze\n"
+    "{strengths}\n\n"
+    "## Missing / Not Evident Requirements (from JD) / Trūkstošās prasības\n"
+    "{missing_requirements}"
+)
 
-    return instruct
+
+def read_text(path: Path) -> str:
+    with path.open("r", encoding="utf-8") as f:
+        return f.read().strip()
+
+
+def build_prompt_prefix(jd_text: str) -> str:
+    return _PROMPT_PREFIX.format(jd=jd_text)
+
+
+def build_prompt_suffix(cv_text: str, candidate_label: str = "Candidate") -> str:
+    return _PROMPT_SUFFIX.format(cv=cv_text, candidate_label=candidate_label)
+
+
+def build_prompt(jd_text: str, cv_text: str, candidate_label: str = "Candidate") -> str:
+    return build_prompt_prefix(jd_text) + build_prompt_suffix(cv_text, candidate_label)
+
+
+def write_in_background(path: Path, data: bytes):
+    def report_error(future: Future):
+        if future.exception() is not None:
+            print(f"Error while writing {path}: {future.exception()}")
+
+    IO_POOL.submit(path.write_bytes, data).add_done_callback(report_error)
 
 
 def save_prompt_md(text: str, path: Path):
-    path.write_text(text, encoding="utf-8")
+    write_in_background(path, text.encode("utf-8"))
 
 
-def call_gemini(prompt: str) -> dict:
-    url_with_key = f"{API_URL}?key={GEMINI_API_KEY}"
-    
+def build_request(prompt: str, cached_content: str = None, service_tier: str = None) -> dict:
+    request = {
+        "contents": [
+            {
+                "parts": [
+                    {"text": prompt}
+                ],
+                "role": "user"
+            }
+        ],
+        "generationConfig": _GENERATION_CONFIG
+    }
+    if cached_content:
+        request["cachedContent"] = cached_content
+    if service_tier:
+        request["serviceTier"] = service_tier
+    return request
+
+
+class RequestLimiter:
+    """Ierobežo vienlaicīgos pieprasījumus un to biežumu (žetonu spainis) visiem uzdevumiem kopā.
+
+    `async with` aizņem vietu vienlaicīgo pieprasījumu limitā; katram HTTP mēģinājumam
+    (arī atkārtojumiem) jāņem žetons ar `take_token()`.
+    """
+
+    def __init__(self, concurrency: int, requests_per_minute: int):
+        self.sem = asyncio.Semaphore(concurrency)
+        self.lock = asyncio.Lock()
+        self.rate = requests_per_minute / 60.0
+        # Bez uzkrātā "burst": jebkurā 60 s logā ne vairāk kā requests_per_minute žetonu
+        self.capacity = 1.0
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+
+    async def take_token(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def __aenter__(self):
+        await self.sem.acquire()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.sem.release()
+
+
+def make_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(limit=POOL_SIZE, keepalive_timeout=KEEPALIVE_TIMEOUT)
     headers = {
         "Content-Type": "application/json",
+        "x-goog-api-key": GEMINI_API_KEY,
     }
+    return aiohttp.ClientSession(
+        connector=connector,
+        headers=headers,
+        timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+    )
+
+
+class APIError(RuntimeError):
+    def __init__(self, message: str, status: int = None, timed_out: bool = False):
+        super().__init__(message)
+        self.status = status
+        self.timed_out = timed_out
+
+
+def retry_delay(headers, body: bytes, attempt: int) -> float:
+    """Cik ilgi gaidīt pirms atkārtošanas: Retry-After galvene, Gemini RetryInfo vai eksponenciāls backoff."""
+    retry_after = headers.get("Retry-After")
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                delay = None
+        if delay is not None:
+            return min(max(delay, 0.0), MAX_RETRY_DELAY)
+
+    try:
+        details = orjson.loads(body)["error"].get("details", [])
+        for detail in details:
+            if detail.get("@type", "").endswith("google.rpc.RetryInfo"):
+                return min(float(detail["retryDelay"].rstrip("s")), MAX_RETRY_DELAY)
+    except (orjson.JSONDecodeError, KeyError, TypeError, AttributeError, ValueError):
+        pass
+
+    return RETRY_BACKOFF * 2 ** attempt
+
+
+async def api_request(session: aiohttp.ClientSession, method: str, url: str, payload: dict = None,
+                      limiter: RequestLimiter = None, timeout: float = None, retry_timeouts: bool = True) -> dict:
+    data = orjson.dumps(payload) if payload is not None else None
+    # Bez `timeout` tiek izmantots sesijas noklusējums (REQUEST_TIMEOUT)
+    options = {"timeout": aiohttp.ClientTimeout(total=timeout)} if timeout else {}
+    for attempt in range(MAX_RETRIES + 1):
+        if limiter:
+            await limiter.take_token()
+        try:
+            async with session.request(method, url, data=data, **options) as resp:
+                status, reason = resp.status, resp.reason
+                headers = resp.headers
+                body = await resp.read()
+        except asyncio.TimeoutError as e:
+            if retry_timeouts and attempt < MAX_RETRIES:
+                await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+                continue
+            raise APIError(f"API request timed out: {e!r}", timed_out=True)
+        except aiohttp.ClientError as e:
+            if attempt < MAX_RETRIES:
+                await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+                continue
+            raise APIError(f"API request failed: {e!r}")
+
+        # 429 / 5xx: pārejoša kļūda, pagaidām (cik serveris lūdz) un mēģinām vēlreiz
+        if status in RETRY_STATUSES and attempt < MAX_RETRIES:
+            await asyncio.sleep(retry_delay(headers, body, attempt))
+            continue
+        break
+
+    if status >= 400:
+        error_msg = f"API request failed: {status} {reason}"
+        try:
+            error_msg += f" - API Error: {orjson.loads(body)['error']['message']}"
+        except (orjson.JSONDecodeError, KeyError, TypeError):
+            error_msg += f" - response: {body.decode('utf-8', 'replace')}"
+        raise APIError(error_msg, status)
+
+    try:
+        return orjson.loads(body)
+    except orjson.JSONDecodeError as e:
+        raise APIError(f"API returned a non-JSON response ({status}): {e} - response: {body.decode('utf-8', 'replace')}", status)
+
+
+class InvalidResponseError(RuntimeError):
+    """Modelis atbildēja, bet atbilde neatbilst HRReview shēmai; `raw_text` glabā to pārbaudei."""
+
+    def __init__(self, message: str, raw_text: str):
+        super().__init__(message)
+        self.raw_text = raw_text
+
 
-   
+def parse_response(data: dict) -> dict:
+    candidates = data.get("candidates") or []
+    parts = candidates[0].get("content", {}).get("parts", []) if candidates else []
+    json_text = "".join(part.get("text", "") for part in parts if not part.get("thought")).strip()
+    if not json_text:
+        reason = data.get("promptFeedback", {}).get("blockReason") or (candidates[0].get("finishReason") if candidates else None)
+        raise RuntimeError(f"Nevarēja atrast teksta atbildi Gemini API atbildē (iemesls: {reason}). Pilns API atbildes saturs:\n" + orjson.dumps(data, option=JSON_DUMP_OPTIONS).decode("utf-8"))
+
+    # Parsēšana un validācija vienā solī, bez starpposma dict
+    try:
+        review = _DECODER.decode(json_text)
+    except msgspec.DecodeError as e:
+        raise InvalidResponseError(f"Modeļa JSON neatbilst shēmai: {e}", json_text)
+
+    return msgspec.structs.asdict(review)
+
+
+async def call_gemini(session: aiohttp.ClientSession, prompt: str, cached_content: str = None,
+                      limiter: RequestLimiter = None) -> dict:
+    if not SERVICE_TIER:
+        return parse_response(await api_request(session, "POST", API_URL, build_request(prompt, cached_content), limiter))
+
+    # Flex atbilde var ilgt minūtes, tāpēc savs taimauts; taimautu neatkārtojam, bet pārejam uz standarta līmeni
+    timeout = FLEX_REQUEST_TIMEOUT if SERVICE_TIER == "flex" else None
+    try:
+        data = await api_request(session, "POST", API_URL, build_request(prompt, cached_content, SERVICE_TIER), limiter,
+                                 timeout=timeout, retry_timeouts=False)
+    except APIError as e:
+        # Flex pieprasījumi tiek izmesti, ja trūkst jaudas — vienreiz mēģinām standarta līmenī
+        if not e.timed_out and e.status not in FLEX_FALLBACK_STATUSES:
+            raise
+        reason = "timed out" if e.timed_out else e.status
+        print(f"Request at '{SERVICE_TIER}' service tier was dropped ({reason}), retrying at standard tier")
+        data = await api_request(session, "POST", API_URL, build_request(prompt, cached_content), limiter)
+    return parse_response(data)
+
+
+def prompt_cache_ttl(request_count: int) -> int:
+    """Sekundes, kas vajadzīgas, lai RPM limitā nosūtītu visus pieprasījumus un sagaidītu pēdējo atbildi."""
+    send_time = math.ceil(request_count * 60 / REQUESTS_PER_MINUTE)
+    response_time = FLEX_REQUEST_TIMEOUT if SERVICE_TIER == "flex" else REQUEST_TIMEOUT
+    return send_time + response_time + PROMPT_CACHE_TTL_MARGIN
+
+
+async def create_prompt_cache(session: aiohttp.ClientSession, prompt_prefix: str, ttl: int) -> str:
+    """Izveido Gemini kešu kopīgajam prompta prefiksam uz `ttl` sekundēm; atgriež tā nosaukumu vai None."""
+    if estimate_tokens(prompt_prefix) < PROMPT_CACHE_MIN_TOKENS:
+        # API šādu kešu noraidītu; īsam prefiksam pietiek ar implicīto kešošanu
+        print(f"Prompt prefix is below {PROMPT_CACHE_MIN_TOKENS} tokens, sending full prompts without a prompt cache")
+        return None
     payload = {
+        "model": f"models/{MODEL_NAME}",
         "contents": [
             {
                 "parts": [
-                    {"text": prompt}
-                ]
+                    {"text": prompt_prefix}
+                ],
+                "role": "user"
             }
         ],
-        "generationConfig": {
-            "temperature": TEMPERATURE,
-            
-            "responseMimeType": "application/json",
-            
-            "responseSchema": {
-                "type": "object",
-                "properties": {
-                    "match_score": {"type": "integer"},
-                    "summary": {"type": "string"},
-                    "strengths": {"type": "array", "items": {"type": "string"}},
-                    "missing_requirements": {"type": "array", "items": {"type": "string"}},
-                    "verdict": {"type": "string", "enum": ["strong match", "possible match", "not a match"]}
-                },
-                "required": REQUIRED_KEYS
-            }
-        }
+        "ttl": f"{ttl}s"
     }
+    try:
+        cache = await api_request(session, "POST", f"{API_ROOT}/cachedContents", payload)
+    except RuntimeError as e:
+        print(f"Prompt cache not created, sending full prompts instead: {e}")
+        return None
+    return cache.get("name")
 
-    resp = requests.post(url_with_key, headers=headers, json=payload, timeout=60)
-    
+
+def is_missing_cache_error(error: APIError) -> bool:
+    return error.status in CACHE_MISSING_STATUSES and "cachedcontent" in str(error).lower().replace(" ", "")
+
+
+async def delete_prompt_cache(session: aiohttp.ClientSession, cache_name: str):
     try:
-        resp.raise_for_status()
-    except Exception as e:
-        error_msg = f"API request failed: {e}"
+        await api_request(session, "DELETE", f"{API_ROOT}/{cache_name}")
+    except RuntimeError as e:
+        print(f"Warning: could not delete prompt cache {cache_name}: {e}")
+
+
+async def embed_text(session: aiohttp.ClientSession, text: str, limiter: RequestLimiter = None) -> list:
+    payload = {
+        "content": {
+            "parts": [
+                {"text": text}
+            ]
+        },
+        "taskType": "SEMANTIC_SIMILARITY",
+        "outputDimensionality": EMBED_DIMENSIONS
+    }
+    data = await api_request(session, "POST", EMBED_API_URL, payload, limiter)
+    values = data["embedding"]["values"]
+    # Normalizējam, lai kosinusa līdzība būtu vienkāršs skalārais reizinājums
+    norm = math.sqrt(sum(x * x for x in values)) or 1.0
+    return [x / norm for x in values]
+
+
+class CVDeduper:
+    """Atpazīst gandrīz identiskus CV pēc embedding līdzības un atkārtoti izmanto to rezultātu.
+
+    Ieraksti ir nākotnes (Future) objekti, tāpēc dublikāts, kura oriģināls vēl tiek
+    apstrādāts, vienkārši gaida tā rezultātu, nevis izsauc modeli vēlreiz.
+    """
+
+    def __init__(self, scope: str, limiter: RequestLimiter, response_cache: ResponseCache = None,
+                 threshold: float = DEDUPE_THRESHOLD):
+        self.scope = scope
+        self.limiter = limiter
+        self.response_cache = response_cache
+        self.threshold = threshold
+        # (vektors, Future, rowid kešā vai None šīs palaišanas ierakstiem, oriģinālā CV kandidāts)
+        self.entries = []
+        loop = asyncio.get_running_loop()
+        for rowid, vector, model_json, source in (response_cache.embeddings(scope) if response_cache else []):
+            future = loop.create_future()
+            future.set_result(model_json)
+            self.entries.append((vector, future, rowid, source))
+
+    async def lookup(self, session: aiohttp.ClientSession, cv_text: str, label: str):
+        """Atgriež (rezultāts, reused_from, None) līdzīgam CV vai (None, None, claim), ja šis CV jāapstrādā pašam.
+
+        `reused_from` ir {"candidate": oriģinālais CV, "similarity": kosinuss}, lai pārņemtais
+        rezultāts nebūtu sajaucams ar īstu novērtējumu.
+        """
         try:
-            error_data = resp.json()
-            if 'error' in error_data:
-                error_msg += f" - API Error: {error_data['error']['message']}"
-        except json.JSONDecodeError:
-            error_msg += f" - response: {resp.text}"
-        raise RuntimeError(error_msg)
+            async with self.limiter:
+                vector = await embed_text(session, cv_text, self.limiter)
+        except (RuntimeError, KeyError) as e:
+            print(f"Warning: could not embed CV for deduplication: {e}")
+            return None, None, None
+
+        best, best_score = None, -1.0
+        for entry in self.entries:
+            score = sum(a * b for a, b in zip(vector, entry[0]))
+            if score > best_score:
+                best, best_score = entry, score
+
+        if best is not None and best_score >= self.threshold:
+            _, best_future, rowid, source = best
+            model_json = await best_future
+            if model_json is not None:
+                if rowid is not None and self.response_cache:
+                    self.response_cache.touch_embedding(rowid)
+                return model_json, {"candidate": source, "similarity": round(best_score, 4)}, None
+
+        future = asyncio.get_running_loop().create_future()
+        self.entries.append((vector, future, None, label))
+        return None, None, (vector, future, label)
+
+    def release(self, claim, model_json: dict = None):
+        """Paziņo rezultātu gaidošajiem dublikātiem; None nozīmē, ka tie izsauks modeli paši."""
+        vector, future, label = claim
+        if not future.done():
+            future.set_result(model_json)
+        if model_json is not None and self.response_cache:
+            self.response_cache.put_embedding(self.scope, vector, model_json, label)
+
+
+async def call_gemini_batch(session: aiohttp.ClientSession, prompts: dict) -> dict:
+    """Iesniedz visus promptus vienā Batch API darbā un gaida rezultātu.
+
+    `prompts` ir {atslēga: prompts}; atgriež {atslēga: parsēts JSON vai RuntimeError}.
+    """
+    payload = {
+        "batch": {
+            "display_name": BATCH_DISPLAY_NAME,
+            "input_config": {
+                "requests": {
+                    "requests": [
+                        {"request": build_request(prompt), "metadata": {"key": key}}
+                        for key, prompt in prompts.items()
+                    ]
+                }
+            }
+        }
+    }
+    if len(orjson.dumps(payload)) > BATCH_INLINE_LIMIT:
+        raise RuntimeError("Batch pieprasījums pārsniedz 20MB inline limitu; sadaliet CV vairākos darbos.")
+
+    if BATCH_RESUME_NAME:
+        op = {"name": BATCH_RESUME_NAME}
+        print(f"Resuming batch job {BATCH_RESUME_NAME}. Waiting for results...")
+    else:
+        op = await api_request(session, "POST", BATCH_API_URL, payload)
+        print(f"Submitted batch job {op['name']} with {len(prompts)} requests. Waiting for results...")
+        print(f"If this run is interrupted, resume it with GEMINI_BATCH_NAME={op['name']}")
+
+    name = op["name"]
+    while not op.get("done"):
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+        try:
+            op = await api_request(session, "GET", f"{API_ROOT}/{name}")
+        except APIError as e:
+            # Īslaicīgs tīkla vai servera traucējums nedrīkst pazaudēt darbu, kas joprojām tiek izpildīts
+            if e.status is not None and e.status not in RETRY_STATUSES:
+                raise
+            print(f"Warning: polling batch job {name} failed, retrying in {BATCH_POLL_INTERVAL}s: {e}")
+
+    if "error" in op:
+        raise RuntimeError(f"Batch job failed: {op['error'].get('message', op['error'])}")
+
+    inlined = op.get("response", {}).get("inlinedResponses", {})
+    if isinstance(inlined, dict):
+        inlined = inlined.get("inlinedResponses", [])
+
+    results = {}
+    for item in inlined:
+        key = item.get("metadata", {}).get("key")
+        if "error" in item:
+            results[key] = RuntimeError(f"API Error: {item['error'].get('message', item['error'])}")
+            continue
+        try:
+            results[key] = parse_response(item.get("response", {}))
+        except RuntimeError as e:
+            results[key] = e
+    return results
 
-    data = resp.json()
 
-    
-    try:
-        json_text = data['candidates'][0]['content']['parts'][0]['text'].strip()
-    except (KeyError, IndexError):
-        raise RuntimeError("Nevarēja atrast teksta atbildi Gemini API atbildē. Pilns API atbildes saturs:\n" + json.dumps(data, ensure_ascii=False, indent=2))
+def generate_report_md(json_obj: dict, candidate_label: str, out_path: Path, reused_from: dict = None):
+    reused_note = ""
+    if reused_from:
+        # Rezultāts nav iegūts šim CV, bet pārņemts no gandrīz identiska — to parādām atskaitē
+        reused_note = (f"  \n**Reused from:** {reused_from['candidate']} "
+                       f"(cosine similarity {reused_from['similarity']:.3f}), not scored separately")
+    out_text = _REPORT_TEMPLATE.format_map({
+        "candidate_label": candidate_label,
+        "match_score": json_obj.get('match_score'),
+        "verdict": json_obj.get('verdict'),
+        "reused_note": reused_note,
+        "summary": json_obj.get('summary'),
+        "strengths": "".join(f"\n- {s}" for s in json_obj.get('strengths', [])),
+        "missing_requirements": "".join(f"\n- {m}" for m in json_obj.get('missing_requirements', [])),
+    })
+    write_in_background(out_path, out_text.encode("utf-8"))
 
 
-    try:
-        parsed = json.loads(json_text)
-    except json.JSONDecodeError as e:
-        raise RuntimeError(f"Nevarēja parsēt JSON atbildi: {e}. Teksts: {json_text}")
-        
-    return parsed
+def response_cache_key(prompt: str) -> str:
+    return make_key(MODEL_NAME, TEMPERATURE, prompt, _RESPONSE_SCHEMA)
 
 
-def validate_hr_json(obj: dict) -> bool:
-    if not isinstance(obj, dict):
-        return False
-    for k in REQUIRED_KEYS:
-        if k not in obj:
-            return False
+def save_raw_response(raw_text: str, i: int, label: str):
+    print(f"Warning: model JSON for {label} failed validation. Saving raw response for inspection.")
+    write_in_background(OUTPUT_DIR / f"cv{i}_raw.json", raw_text.encode("utf-8"))
 
-    if not isinstance(obj.get("match_score"), int) or not (0 <= obj.get("match_score") <= 100):
-        return False
-    if not isinstance(obj.get("summary"), str):
-        return False
-    if not isinstance(obj.get("strengths"), list):
-        return False
-    if not isinstance(obj.get("missing_requirements"), list):
-        return False
-    if obj.get("verdict") not in ["strong match", "possible match", "not a match"]:
-        return False
-    return True
 
+def save_results(model_json: dict, i: int, label: str, reused_from: dict = None):
+    out_json_path = OUTPUT_DIR / f"cv{i}.json"
+    out_json = {**model_json, "reused_from": reused_from} if reused_from else model_json
+    write_in_background(out_json_path, orjson.dumps(out_json, option=JSON_DUMP_OPTIONS))
+    print(f"Saved JSON result for {label} -> {out_json_path}")
 
-def generate_report_md(json_obj: dict, candidate_label: str, out_path: Path):
-    md = []
-    md.append(f"# CV Review — {candidate_label} (Gemini Flash 2.5)\n")
-    md.append(f"**Match score:** {json_obj.get('match_score')} / 100  ")
-    md.append(f"**Verdict:** {json_obj.get('verdict')}\n")
-    md.append("## Summary\n")
-    md.append(json_obj.get('summary') + "\n")
-    md.append("## Strengths (from CV) / Galvenās prasmes un pieredze\n")
-    for s in json_obj.get('strengths', []):
-        md.append(f"- {s}")
-    md.append("\n## Missing / Not Evident Requirements (from JD) / Trūkstošās prasības\n")
-    for m in json_obj.get('missing_requirements', []):
-        md.append(f"- {m}")
 
-    out_text = "\n".join(md)
-    out_path.write_text(out_text, encoding='utf-8')
+    report_path = OUTPUT_DIR / f"cv{i}_report.md"
+    generate_report_md(model_json, label, report_path, reused_from)
+    print(f"Saved report for {label} -> {report_path}")
 
 
-def main():
-    try:
-        jd_text = read_text(JD_PATH) 
-    except FileNotFoundError:
-        print(f"Kļūda: Darba apraksta fails '{JD_PATH}' (jd.txt) nav atrasts. Lūdzu pārliecinieties, ka 'sample_inputs/jd.txt' pastāv.")
-        return
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN
+
+
+def prompt_fits(prompt_text: str, label: str) -> bool:
+    # Pārbaudām pirms sūtīšanas, lai nemaksātu par tīkla ceļu līdz garantētam noraidījumam
+    tokens = estimate_tokens(prompt_text)
+    if tokens > MAX_INPUT_TOKENS:
+        print(f"Kļūda: prompts kandidātam {label} ir ~{tokens} tokenu, vairāk par {MAX_INPUT_TOKENS} limitu. Izlaižam šo kandidātu.")
+        return False
+    return True
+
 
+def load_cvs() -> list:
+    # Visi CV tiek nolasīti vienreiz pirms API izsaukumiem: [(i, label, cv_text)]
+    cvs = []
     for i, cv_path in enumerate(CV_PATHS, start=1):
         try:
             cv_text = read_text(cv_path) 
         except FileNotFoundError:
             print(f"Kļūda: CV fails '{cv_path}' nav atrasts. Izlaižam šo kandidātu.")
             continue
-            
-        label = f"Candidate {i}"
-
-       
-        prompt_text = build_prompt(jd_text, cv_text, candidate_label=label)
-        prompt_file = PROMPT_DIR / f"prompt_cv{i}.md"
-        save_prompt_md(prompt_text, prompt_file)
-        print(f"Saved prompt for {label} -> {prompt_file}")
-
-     
-        print(f"Calling model {MODEL_NAME} for {label}... (this may take a few seconds)")
-        try:
-            model_json = call_gemini(prompt_text)
-        except RuntimeError as e:
-            print(f"Error while calling model for {label}: {e}")
+        cvs.append((i, f"Candidate {i}", cv_text))
+    return cvs
+
+
+def prepare_prompt(i: int, label: str, cv_text: str) -> str:
+    prompt_suffix = build_prompt_suffix(cv_text, candidate_label=label)
+    # Kopīgais prefikss ir PROMPT_PREFIX_PATH; pilns prompts = prefikss + šis fails
+    prompt_file = PROMPT_DIR / f"prompt_cv{i}_suffix.md"
+    save_prompt_md(prompt_suffix, prompt_file)
+    print(f"Saved prompt for {label} -> {prompt_file}")
+    return prompt_suffix
+
+
+def serve_cached_responses(cvs: list, prompt_prefix: str, response_cache: ResponseCache = None) -> list:
+    """Saglabā rezultātus no lokālā keša; atgriež [(i, label, cv_text, prompt_suffix)] CV, kam vajag modeļa izsaukumu."""
+    pending = []
+    for i, label, cv_text in cvs:
+        prompt_suffix = prepare_prompt(i, label, cv_text)
+        prompt_text = prompt_prefix + prompt_suffix
+        cached = response_cache.get(response_cache_key(prompt_text)) if response_cache else None
+        if cached is not None:
+            print(f"Using cached model response for {label}")
+            save_results(cached, i, label)
             continue
-
-    
-        if not validate_hr_json(model_json):
-            print(f"Warning: model JSON for {label} failed validation. Saving raw response for inspection.")
-            (OUTPUT_DIR / f"cv{i}_raw.json").write_text(json.dumps(model_json, ensure_ascii=False, indent=2), encoding='utf-8')
+        # Viens pārāk garš pieprasījums nedrīkst izgāzt pārējos
+        if not prompt_fits(prompt_text, label):
             continue
+        pending.append((i, label, cv_text, prompt_suffix))
+    return pending
+
+
+async def process_cv(session: aiohttp.ClientSession, limiter: RequestLimiter, i: int, label: str, cv_text: str,
+                     prompt_prefix: str, prompt_suffix: str, cache_name: str = None,
+                     response_cache: ResponseCache = None, deduper: CVDeduper = None):
+    claim = None
+    if deduper:
+        reused, reused_from, claim = await deduper.lookup(session, cv_text, label)
+        if reused is not None:
+            print(f"Reusing model response of {reused_from['candidate']} "
+                  f"(cosine similarity {reused_from['similarity']:.3f}) for {label}")
+            save_results(reused, i, label, reused_from)
+            return
+
+    # Ar kešu sūtām tikai CV daļu; bez tā — pilnu promptu ar to pašu prefiksu
+    prompt_text = prompt_suffix if cache_name else prompt_prefix + prompt_suffix
+
+    model_json = None
+    try:
+        async with limiter:
+            print(f"Calling model {MODEL_NAME} for {label}... (this may take a few seconds)")
+            try:
+                try:
+                    model_json = await call_gemini(session, prompt_text, cached_content=cache_name, limiter=limiter)
+                except APIError as e:
+                    # Kešs var būt beidzies vai izdzēsts — šo CV sūtām ar pilnu promptu
+                    if not cache_name or not is_missing_cache_error(e):
+                        raise
+                    print(f"Prompt cache unavailable for {label}, sending full prompt instead: {e}")
+                    model_json = await call_gemini(session, prompt_prefix + prompt_suffix, limiter=limiter)
+            except InvalidResponseError as e:
+                save_raw_response(e.raw_text, i, label)
+                return
+            except RuntimeError as e:
+                print(f"Error while calling model for {label}: {e}")
+                return
+
+        save_results(model_json, i, label)
+        if response_cache:
+            response_cache.put(response_cache_key(prompt_prefix + prompt_suffix), model_json)
+    finally:
+        if claim:
+            deduper.release(claim, model_json)
+
+
+async def process_batch(session: aiohttp.ClientSession, cvs: list, prompt_prefix: str,
+                        response_cache: ResponseCache = None):
+    jobs = {
+        f"cv{i}": (i, label, prompt_prefix + prompt_suffix)
+        for i, label, _, prompt_suffix in serve_cached_responses(cvs, prompt_prefix, response_cache)
+    }
+    if not jobs:
+        return
 
-        out_json_path = OUTPUT_DIR / f"cv{i}.json"
-        out_json_path.write_text(json.dumps(model_json, ensure_ascii=False, indent=2), encoding='utf-8')
-        print(f"Saved JSON result for {label} -> {out_json_path}")
+    if not BATCH_RESUME_NAME:
+        print(f"Submitting batch job to {MODEL_NAME} for {len(jobs)} candidates... (this may take up to 24h)")
+    try:
+        results = await call_gemini_batch(session, {key: prompt for key, (_, _, prompt) in jobs.items()})
+    except RuntimeError as e:
+        print(f"Error while running batch job: {e}")
+        return
 
-   
-        report_path = OUTPUT_DIR / f"cv{i}_report.md"
-        generate_report_md(model_json, label, report_path)
-        print(f"Saved report for {label} -> {report_path}")
+    for key, (i, label, prompt_text) in jobs.items():
+        model_json = results.get(key)
+        if model_json is None:
+            print(f"Error while calling model for {label}: batch job returned no response")
+        elif isinstance(model_json, InvalidResponseError):
+            save_raw_response(model_json.raw_text, i, label)
+        elif isinstance(model_json, RuntimeError):
+            print(f"Error while calling model for {label}: {model_json}")
+        else:
+            save_results(model_json, i, label)
+            if response_cache:
+                response_cache.put(response_cache_key(prompt_text), model_json)
+
+
+async def main():
+    try:
+        jd_text = read_text(JD_PATH) 
+    except FileNotFoundError:
+        print(f"Kļūda: Darba apraksta fails '{JD_PATH}' (jd.txt) nav atrasts. Lūdzu pārliecinieties, ka 'sample_inputs/jd.txt' pastāv.")
+        return
 
-       
-        time.sleep(1)
+    cvs = load_cvs()
+    if not cvs:
+        return
 
+    prompt_prefix = build_prompt_prefix(jd_text)
+    save_prompt_md(prompt_prefix, PROMPT_PREFIX_PATH)
+    print(f"Saved shared prompt prefix -> {PROMPT_PREFIX_PATH}")
+    response_cache = ResponseCache(RESPONSE_CACHE_PATH) if USE_RESPONSE_CACHE else None
 
-if __name__ == '__main__':
+    try:
+        async with make_session() as session:
+            if USE_BATCH:
+                # Batch darbs var ilgt ilgāk par keša TTL, tāpēc tur paļaujamies uz implicīto kešošanu
+                await process_batch(session, cvs, prompt_prefix, response_cache)
+                return
+            # Vispirms lokālais kešs: ja visi CV jau novērtēti, prompta kešu neveidojam
+            pending = serve_cached_responses(cvs, prompt_prefix, response_cache)
+            if not pending:
+                return
+            cache_name = await create_prompt_cache(session, prompt_prefix, prompt_cache_ttl(len(pending))) if USE_PROMPT_CACHE else None
+            limiter = RequestLimiter(CONCURRENCY, REQUESTS_PER_MINUTE)
+            # Rezultātus drīkst pārņemt tikai no CV, kas vērtēti pret to pašu JD un instrukcijām
+            dedupe_scope = hashlib.sha256(f"{MODEL_NAME}\n{prompt_prefix}".encode("utf-8")).hexdigest()
+            deduper = None
+            if USE_CV_DEDUPE:
+                deduper = CVDeduper(dedupe_scope, RequestLimiter(CONCURRENCY, EMBED_REQUESTS_PER_MINUTE), response_cache)
+            try:
+                results = await asyncio.gather(*[
+                    process_cv(session, limiter, i, label, cv_text, prompt_prefix, prompt_suffix, cache_name,
+                               response_cache, deduper)
+                    for i, label, cv_text, prompt_suffix in pending
+                ], return_exceptions=True)
+                # Negaidīta kļūda vienā CV nedrīkst pārtraukt pārējos — ziņojam par katru atsevišķi
+                for (_, label, _, _), result in zip(pending, results):
+                    if isinstance(result, Exception):
+                        print(f"Error while processing {label}: {result!r}")
+            finally:
+                if cache_name:
+                    await delete_prompt_cache(session, cache_name)
+    finally:
+        if response_cache:
+            response_cache.close()
+        IO_POOL.shutdown(wait=True)
 
-    main()
 
+if __name__ == '__main__':
 
+    asyncio.run(main())
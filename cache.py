@@ -0,0 +1,122 @@
+"""Lokāls SQLite kešs Gemini atbildēm.
+
+Atslēga ir SHA-256 no (modelis, temperatūra, prompts, shēma), tāpēc atkārtota
+palaišana ar tiem pašiem JD un CV failiem neizsauc API.
+"""
+import hashlib
+from array import array
+import sqlite3
+import time
+import unicodedata
+from pathlib import Path
+
+import orjson
+
+
+DEFAULT_TTL = 7 * 24 * 3600
+DEFAULT_MAX_ENTRIES = 1000
+
+
+def make_key(model: str, temperature: float, prompt: str, schema) -> str:
+    # NFC normalizācija + sakārtotas atslēgas, lai formāta sīkumi nemainītu atslēgu
+    prompt = unicodedata.normalize("NFC", prompt)
+    raw = orjson.dumps(
+        {"model": model, "temp": temperature, "prompt": prompt, "schema": schema},
+        option=orjson.OPT_SORT_KEYS,
+    )
+    return hashlib.sha256(raw).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path: Path, ttl: int = DEFAULT_TTL, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " response BLOB NOT NULL,"
+            " created_at INTEGER NOT NULL,"
+            " expires_at INTEGER NOT NULL,"
+            " last_used INTEGER NOT NULL)"  # ns, lai LRU secība būtu precīza
+        )
+        # CV embedding vektori ar rezultātiem gandrīz identisku CV atpazīšanai
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cv_embeddings ("
+            " scope TEXT NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " response BLOB NOT NULL,"
+            " source TEXT NOT NULL,"  # CV, kuram rezultāts tika iegūts
+            " expires_at INTEGER NOT NULL,"
+            " last_used INTEGER NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS cv_embeddings_scope ON cv_embeddings (scope)")
+        self.conn.commit()
+
+    def get(self, key: str):
+        row = self.conn.execute(
+            "SELECT response, expires_at FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        now = int(time.time())
+        if row[1] <= now:
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.conn.commit()
+            return None
+
+        self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time_ns(), key))
+        self.conn.commit()
+        return orjson.loads(row[0])
+
+    def put(self, key: str, value: dict):
+        now = int(time.time())
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses (key, response, created_at, expires_at, last_used)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (key, orjson.dumps(value), now, now + self.ttl, time.time_ns()),
+        )
+        # Izmetam novecojušos ierakstus un vecākos pēc LRU, ja pārsniegts limits
+        self.conn.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+        self.conn.execute(
+            "DELETE FROM responses WHERE key NOT IN"
+            " (SELECT key FROM responses ORDER BY last_used DESC LIMIT ?)",
+            (self.max_entries,),
+        )
+        self.conn.commit()
+
+    def embeddings(self, scope: str) -> list:
+        """Atgriež [(rowid, vektors, atbilde, avots)] visiem nenovecojušajiem ierakstiem dotajā `scope`."""
+        rows = self.conn.execute(
+            "SELECT rowid, vector, response, source FROM cv_embeddings WHERE scope = ? AND expires_at > ?",
+            (scope, int(time.time())),
+        ).fetchall()
+        return [
+            (rowid, array("f", vector).tolist(), orjson.loads(response), source)
+            for rowid, vector, response, source in rows
+        ]
+
+    def touch_embedding(self, rowid: int):
+        self.conn.execute("UPDATE cv_embeddings SET last_used = ? WHERE rowid = ?", (time.time_ns(), rowid))
+        self.conn.commit()
+
+    def put_embedding(self, scope: str, vector: list, value: dict, source: str) -> int:
+        now = int(time.time())
+        cursor = self.conn.execute(
+            "INSERT INTO cv_embeddings (scope, vector, response, source, expires_at, last_used)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (scope, array("f", vector).tobytes(), orjson.dumps(value), source, now + self.ttl, time.time_ns()),
+        )
+        # Tāpat kā atbildēm: novecojušie ārā, pārējie apgriezti līdz max_entries pēc LRU
+        self.conn.execute("DELETE FROM cv_embeddings WHERE expires_at <= ?", (now,))
+        self.conn.execute(
+            "DELETE FROM cv_embeddings WHERE rowid NOT IN"
+            " (SELECT rowid FROM cv_embeddings ORDER BY last_used DESC LIMIT ?)",
+            (self.max_entries,),
+        )
+        self.conn.commit()
+        return cursor.lastrowid
+
+    def close(self):
+        self.conn.close()